@@ -1,20 +1,114 @@
 import os
 import sys
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql import func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.sql import bindparam, cast, func, select
+from flask_compress import Compress
 from flask_cors import CORS
+import hashlib
 import random
+import time
+import orjson
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 QUESTIONS_PER_PAGE = 10
+CATEGORIES_CACHE_TTL = 300 # seconds
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+
+'''
+Quiz statements are built once and compiled once into QUIZ_COMPILED_CACHE. previous_questions is bound
+as a single integer array and unnested, so the SQL text and Postgres' plan stay the same however long
+the quiz runs, instead of growing an IN (...) list by one parameter per question.
+'''
+QUIZ_COMPILED_CACHE = {}
+QUIZ_CANDIDATE_IDS = select([Question.id]).where(Question.id.notin_(
+  select([func.unnest(cast(bindparam('previous_questions', type_=ARRAY(Integer)), ARRAY(Integer)))])))
+QUIZ_CATEGORY_CANDIDATE_IDS = QUIZ_CANDIDATE_IDS.where(Question.category == bindparam('quiz_category'))
+QUIZ_QUESTION = select(list(QUESTION_COLUMNS)).where(Question.id == bindparam('question_id'))
+
+'''
+question_row_to_dict(row)
+    formats a row selected with QUESTION_COLUMNS the same way as Question.format(),
+    without building an ORM instance
+'''
+def question_row_to_dict(row):
+  return {
+    'id': row.id,
+    'question': row.question,
+    'answer': row.answer,
+    'category': row.category,
+    'difficulty': row.difficulty
+  }
+
+'''
+json_response(payload, etag=None)
+    serializes a response body with orjson, which is several times faster than jsonify
+    for the list-heavy GET endpoints. When etag is given it is sent as a weak ETag with
+    Cache-Control: no-cache, so clients revalidate it through If-None-Match
+'''
+def json_response(payload, etag=None):
+  response = Response(orjson.dumps(payload), mimetype='application/json')
+  if etag is not None:
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+
+  return response
+
+'''
+not_modified(etag)
+    an empty 304 response for a client whose If-None-Match already holds etag
+'''
+def not_modified(etag):
+  response = Response(status=304)
+  response.set_etag(etag, weak=True)
+  response.cache_control.no_cache = True
+
+  return response
+
+'''
+cached_categories()
+    returns the formatted categories, reloading them at most once every CATEGORIES_CACHE_TTL seconds.
+    Categories are static reference data; clear _categories_cache if an endpoint ever changes them.
+cached_categories_etag()
+    returns an ETag for the currently cached categories
+'''
+_categories_cache = {}
+
+def _load_categories():
+  cached = _categories_cache.get('categories')
+  if cached is None or time.monotonic() - cached[0] > CATEGORIES_CACHE_TTL:
+    categories = [category.format() for category in Category.query.order_by(Category.id).all()]
+    etag = hashlib.md5(orjson.dumps(categories)).hexdigest()
+    cached = (time.monotonic(), categories, etag)
+    _categories_cache['categories'] = cached
+
+  return cached
+
+def cached_categories():
+  return _load_categories()[1]
+
+def cached_categories_etag():
+  return _load_categories()[2]
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  # Let /questions/ and /categories/ also match without their trailing slash instead of registering both forms
+  app.url_map.strict_slashes = False
   setup_db(app)
 
+  '''
+  Compress JSON responses larger than COMPRESS_MIN_SIZE bytes (500 by default) for clients that accept it.
+  The gzip and identity bodies share one ETag, so json_response only sets weak ETags.
+  '''
+  app.config['COMPRESS_MIMETYPES'] = ['application/json']
+  app.config['COMPRESS_LEVEL'] = 5
+  Compress(app)
+
   '''
   Set up CORS. Allow '*' for origins. 
   '''
@@ -33,66 +127,59 @@ def create_app(test_config=None):
     
     return response
 
-  def paginated_questions(request, questions):
+  def paginated_questions(request, query):
     page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    
-    formatted_questions = [question.format() for question in questions]
-    current_questions = formatted_questions[start:end]
-    
-    return current_questions
+    after_id = request.args.get('after_id', 0, type=int)
 
-  def get_questions_by_category(category_id):
-    questions_by_categories = Question.query.filter_by(category=category_id).all()
-    formatted_questions_by_categories = [question.format() for question in questions_by_categories]
+    # Seek past the last id the client has seen so the primary key index does the work;
+    # fall back to OFFSET paging when no after_id is given.
+    query = query.order_by(Question.id)
+    if after_id > 0:
+      query = query.filter(Question.id > after_id)
+    else:
+      query = query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    questions = query.limit(QUESTIONS_PER_PAGE).all()
+    current_questions = [question_row_to_dict(question) for question in questions]
     
-    return formatted_questions_by_categories
+    return current_questions
 
   '''
   Create an endpoint to handle GET requests for all available categories.
   '''
   @app.route('/categories/')
-  @app.route('/categories')
   def get_categories():
-    categories = Category.query.all()
-    formatted_categories = [category.format() for category in categories]
-    
-    return jsonify({
+    etag = cached_categories_etag()
+    if request.if_none_match.contains_weak(etag):
+      return not_modified(etag)
+
+    return json_response({
       'success': True,
-      'categories': formatted_categories
-      })
+      'categories': cached_categories()
+      }, etag)
 
   '''
    An endpoint to handle GET requests for questions, including pagination (every 10 questions). This endpoint returns a list of questions, 
   number of total questions, current category, categories. 
   '''
-  #Chrome will redirect with trailing slash automatically. Added two decorators to resolve different browsers behavior issue.
   @app.route('/questions/')
-  @app.route('/questions') 
   def get_questions():
-    category_list = []
-    category_type = ''
-
     try:
-      questions = Question.query.order_by('id').all()
-      formatted_total_questions = [question.format() for question in questions]
-      current_questions = paginated_questions(request, questions)
-    except:
+      current_questions = paginated_questions(request, db.session.query(*QUESTION_COLUMNS))
+      total_questions = db.session.query(func.count(Question.id)).scalar()
+    except SQLAlchemyError:
+      db.session.rollback()
       abort(400)
 
     if len(current_questions) == 0:
       abort(404)
     else:
-      categories = Category.query.all()
-      for category in categories:
-        category_list.append(category.type)
-
-      return jsonify({
+      return json_response({
         'success': True,
         'questions': current_questions,
-        'categories': category_list,
-        'total_questions': len(questions)
+        'categories': [category['type'] for category in cached_categories()],
+        'total_questions': total_questions,
+        'next_after_id': current_questions[-1]['id']
         })
 
   '''
@@ -100,20 +187,17 @@ def create_app(test_config=None):
   '''
   @app.route('/questions/<int:question_id>', methods=['DELETE'])
   def delete_question(question_id):
+    question = Question.query.get_or_404(question_id)
+
     try:
-      question = Question.query.get(question_id)
-      if question is None:
-        abort(404)
-      
       question.delete()
-      questions = Question.query.order_by('id').all()
-      current_questions = paginated_questions(request, questions)
+    except SQLAlchemyError:
+      db.session.rollback()
+      abort(422)
 
-      return jsonify({
-          "success": True
-          })
-    except:
-      abort(404)
+    return jsonify({
+        "success": True
+        })
   
   '''
   An endpoint to POST a new question, which will require the question and answer text, category, and difficulty score.
@@ -121,31 +205,34 @@ def create_app(test_config=None):
 
   @app.route('/questions', methods=['POST'])
   def create_question():
-    body = request.get_json()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
     new_question = body.get('question')
     new_answer = body.get('answer')
     new_category = body.get('category')
     new_difficulty = body.get('difficulty')
+    if not all(isinstance(text, str) and text.strip() for text in (new_question, new_answer)):
+      abort(400)
+    if not all(isinstance(number, int) and not isinstance(number, bool) for number in (new_category, new_difficulty)):
+      abort(400)
 
     try:
-      new_question = Question(question=new_question, answer=new_answer, category=new_category, difficulty=new_difficulty)
-      new_question.insert()
-      questions = Question.query.order_by('id').all()
-      current_questions = paginated_questions(request, questions)
-      categories = Category.query.all()
-      formatted_categories = [category.format() for category in categories]
+      # Core insert skips the ORM unit of work; the new id comes back via RETURNING on Postgres
+      result = db.session.execute(Question.__table__.insert().values(
+        question=new_question, answer=new_answer, category=new_category, difficulty=new_difficulty))
+      db.session.commit()
 
       return jsonify({
           "success": True,
-          "question": new_question.question,
-          "answer": new_question.answer,
-          "current_category": new_question.category,
-          "difficulty": new_question.difficulty,
-          "questions": current_questions,
-          # "total_questions": len(questions),
-          # "categories" : formatted_categories
+          "id": result.inserted_primary_key[0],
+          "question": new_question,
+          "answer": new_answer,
+          "current_category": new_category,
+          "difficulty": new_difficulty
         })
-    except:
+    except SQLAlchemyError:
+      db.session.rollback()
       abort(422)
 
   '''
@@ -154,47 +241,63 @@ def create_app(test_config=None):
   '''
   @app.route('/questions/search', methods=['POST'])
   def search_questions():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    search = body.get('searchTerm')
+    if not isinstance(search, str):
+      abort(400)
+
     try:
-      body = request.get_json()
-      search = body.get('searchTerm')
-      search_results = Question.query.filter(Question.question.ilike("%" + search + "%"))
-      formatted_matched_questions = [search_result.format() for search_result in search_results]
+      search_results = db.session.query(*QUESTION_COLUMNS).filter(Question.question.ilike("%" + search + "%"))
+      formatted_matched_questions = [question_row_to_dict(search_result) for search_result in search_results]
 
-      questions = Question.query.order_by('id').all()
-      formatted_total_questions = [question.format() for question in questions]
+      total_questions = db.session.query(func.count(Question.id)).scalar()
+    except SQLAlchemyError:
+      db.session.rollback()
+      abort(422)
 
-      return jsonify({
-          "success": True,
-          "questions": formatted_matched_questions,
-          "total_questions": formatted_total_questions,
-          "current_category": formatted_matched_questions[0]['category'],
-          "current_question":formatted_matched_questions[0]
-        })
-    except:
+    if len(formatted_matched_questions) == 0:
       abort(400)
 
+    return jsonify({
+        "success": True,
+        "questions": formatted_matched_questions,
+        "total_questions": total_questions,
+        "current_category": formatted_matched_questions[0]['category'],
+        "current_question":formatted_matched_questions[0]
+      })
+
 
   '''
   A GET endpoint to get questions based on category. 
   '''
   @app.route('/categories/<int:category_id>/questions', methods=['GET'])
   def get_by_category(category_id):
-      try:
-          questions_by_categories = Question.query.filter_by(category=category_id).all()
-          formatted_questions_by_categories = [question.format() for question in questions_by_categories]
+    in_category = Question.category == category_id
+    try:
+      # One aggregate query versions the response, so a matching If-None-Match skips loading the rows
+      total_questions, category_count, category_max_id = db.session.query(
+        func.count(Question.id), func.count(Question.id).filter(in_category), func.max(Question.id).filter(in_category)).one()
+      if category_count == 0:
+        abort(400)
 
-          total_questions = Question.query.order_by('id').all()
-          formatted_total_questions = [question.format() for question in total_questions]
+      etag = '{}-{}-{}-{}'.format(category_id, total_questions, category_count, category_max_id)
+      if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
 
-          return jsonify({
-            "success": True,
-            "questions": formatted_questions_by_categories,
-            "total_questions": formatted_total_questions,
-            "current_category": formatted_questions_by_categories[0]['category']
-            })
+      questions_by_categories = db.session.query(*QUESTION_COLUMNS).filter(in_category).order_by(Question.id).all()
+      formatted_questions_by_categories = [question_row_to_dict(question) for question in questions_by_categories]
+    except SQLAlchemyError:
+      db.session.rollback()
+      abort(422)
 
-      except:
-        abort(400)
+    return json_response({
+      "success": True,
+      "questions": formatted_questions_by_categories,
+      "total_questions": total_questions,
+      "current_category": formatted_questions_by_categories[0]['category']
+      }, etag)
 
 
   '''
@@ -204,31 +307,45 @@ def create_app(test_config=None):
   '''
   @app.route('/quizzes', methods=['POST'])
   def get_next_question():
-    try:
-      body = request.get_json()
-      previous_questions = body.get('previous_questions')
-      quiz_category = body.get('quiz_category')
-      if quiz_category == 0: # When ALL is select, start next question from a random category
-        next_questions = Question.query.filter(Question.id.notin_(previous_questions)).order_by(func.random()).limit(1)
-      else:
-        next_questions = Question.query.filter(Question.category == quiz_category, Question.id.notin_(previous_questions)).order_by(func.random()).limit(1)
-      formatted_next_questions = [question.format() for question in next_questions]
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+      abort(400)
+    previous_questions = body.get('previous_questions', [])
+    quiz_category = body.get('quiz_category')
+    if not isinstance(previous_questions, list):
+      abort(400)
 
-      if len(formatted_next_questions) > 0:
-        return jsonify({
-          "success": True,
-          "question": formatted_next_questions[0], # the first element from the question list
-          "previousQuestions": previous_questions,
-          "guess": '',
-          "showAnswer": False
-          })
+    try:
+      # Sample from the candidate ids in Python rather than ORDER BY random(), which sorts every candidate row
+      # A throwaway branch of the session's connection, so only these statements use the compiled cache
+      # and the session never closes it
+      connection = db.session.connection().execution_options(compiled_cache=QUIZ_COMPILED_CACHE)
+      if quiz_category == 0: # When ALL is select, pick the next question from any category
+        candidate_ids = connection.execute(QUIZ_CANDIDATE_IDS, previous_questions=previous_questions)
       else:
-        return jsonify({
-          "success": False
-          })
+        candidate_ids = connection.execute(QUIZ_CATEGORY_CANDIDATE_IDS,
+          previous_questions=previous_questions, quiz_category=quiz_category)
+      question_ids = [candidate.id for candidate in candidate_ids]
+
+      next_question = None
+      if len(question_ids) > 0:
+        next_question = connection.execute(QUIZ_QUESTION, question_id=random.choice(question_ids)).first()
+    except SQLAlchemyError:
+      db.session.rollback()
+      abort(422)
 
-    except:
-      abort(400)
+    if next_question is not None:
+      return jsonify({
+        "success": True,
+        "question": question_row_to_dict(next_question),
+        "previousQuestions": previous_questions,
+        "guess": '',
+        "showAnswer": False
+        })
+    else:
+      return jsonify({
+        "success": False
+        })
 
   '''
   Error handlers for all expected errors. 
@@ -0,0 +1,9 @@
+import os
+
+# Build the app once in the master process; workers inherit it (URL map, CORS, SQLAlchemy metadata) on fork.
+# Run from the backend directory with: gunicorn 'flaskr.app:create_app()'
+preload_app = True
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
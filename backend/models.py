@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, create_engine, event, DDL
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -8,6 +8,18 @@ database_path = "postgresql://{}/{}".format('localhost:5432', database_name)
 
 db = SQLAlchemy()
 
+'''
+Connection pool settings, overridable per deployment through the environment.
+pool_pre_ping and pool_recycle keep connections dropped by Postgres' idle timeout out of requests.
+'''
+engine_options = {
+    "pool_size": int(os.environ.get("DATABASE_POOL_SIZE", 10)),
+    "max_overflow": int(os.environ.get("DATABASE_MAX_OVERFLOW", 5)),
+    "pool_recycle": int(os.environ.get("DATABASE_POOL_RECYCLE", 1800)),
+    "pool_timeout": int(os.environ.get("DATABASE_POOL_TIMEOUT", 10)),
+    "pool_pre_ping": True
+}
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
@@ -15,9 +27,12 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
     db.app = app
     db.init_app(app)
     db.create_all()
+    # Don't keep create_all's connection in the pool: with gunicorn --preload it would be shared by every forked worker
+    db.get_engine(app).dispose()
 
 '''
 Question
@@ -25,6 +40,12 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  __table_args__ = (
+    db.Index('ix_questions_category_id', 'category', 'id'),
+    # Trigram index so ILIKE '%term%' searches can use an index instead of a sequential scan
+    db.Index('ix_questions_question_trgm', 'question',
+      postgresql_using='gin', postgresql_ops={'question': 'gin_trgm_ops'}),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
@@ -58,6 +79,12 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+event.listen(
+  Question.__table__,
+  'before_create',
+  DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+
 '''
 Category
 
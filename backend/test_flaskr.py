@@ -1,30 +1,50 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
 
 from flaskr.app import create_app
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Initialize the app and create the tables once for the whole test case."""
+        cls.app = create_app()
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgresql://{}/{}".format('localhost:5432', cls.database_name)
+        setup_db(cls.app, cls.database_path)
+        cls.app_session = db.session
+
+    @classmethod
+    def tearDownClass(cls):
+        """Release the pooled connections once every test has run."""
+        db.engine.dispose()
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Run each test inside a transaction that tearDown rolls back."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgresql://{}/{}".format('localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-        
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.create_session({'bind': self.connection, 'binds': {}})()
+        db.session = scoped_session(lambda: self.session)
+        # Flask-SQLAlchemy removes the session after every request; closing it would end the savepoint,
+        # so only drop the loaded objects as a fresh session would
+        db.session.remove = self.session.expunge_all
+
+        # endpoints commit and roll back a SAVEPOINT instead of the outer transaction
+        self.session.begin_nested()
+
+        @event.listens_for(self.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
         self.new_question = {
             'question': 'Test questions',
             'category': 3,
@@ -34,7 +54,10 @@ class TriviaTestCase(unittest.TestCase):
     
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        self.session.close()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
 
     """
     One test for each test for successful operation and for expected errors.
@@ -47,6 +70,13 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertTrue(len(data['categories']))
 
+    def test_304_get_categories_not_modified(self):
+        res = self.client().get("/categories")
+        etag = res.headers['ETag']
+        res = self.client().get("/categories", headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
     def test_get_paginated_questions(self):
         res = self.client().get("/questions")
         data = json.loads(res.data)
@@ -55,6 +85,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(len(data['questions']))
 
+    def test_get_questions_after_id(self):
+        res = self.client().get("/questions")
+        first_page = json.loads(res.data)
+        res = self.client().get("/questions?after_id=" + str(first_page['next_after_id']))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'][0]['id'] > first_page['next_after_id'])
+
     def test_400_sent_requesting_beyond_pages(self):
         res = self.client().get('/questions?page=100', json={'difficulty':1})
         data = json.loads(res.data)
@@ -68,6 +107,15 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertIsInstance(data['total_questions'], int)
+
+    def test_304_get_compressed_questions_by_category(self):
+        res = self.client().get('/categories/4/questions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].startswith('W/'))
+        res = self.client().get('/categories/4/questions', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
 
     def test_400_get_questions_not_in_category(self):
         category_id = 8
@@ -81,6 +129,19 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertIsNotNone(Question.query.get(data['id']))
+
+    def test_400_add_questions_malformed_body(self):
+        res = self.client().post('/questions', data='{not json', content_type='application/json')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_add_questions_empty_body(self):
+        res = self.client().post('/questions', json={})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
 
     def test_405_add_questions_not_allowed(self):
         question_id = 1000
@@ -104,6 +165,30 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_400_search_without_search_term(self):
+        res = self.client().post('/questions/search', json={})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_next_quiz_question(self):
+        res = self.client().post('/quizzes', json={'previous_questions': [5, 9], 'quiz_category': 4})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertNotIn(data['question']['id'], [5, 9])
+        self.assertEqual(str(data['question']['category']), '4')
+
+    def test_422_quiz_with_invalid_previous_questions(self):
+        res = self.client().post('/quizzes', json={'previous_questions': ['not an id'], 'quiz_category': 0})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        # the rollback only undid the savepoint, so later writes stay inside the test's transaction
+        self.assertTrue(self.transaction.is_active)
+        res = self.client().post('/questions', json=self.new_question)
+        self.assertEqual(res.status_code, 200)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -43,8 +43,8 @@ class FormView extends Component {
       data: JSON.stringify({
         question: this.state.question,
         answer: this.state.answer,
-        difficulty: this.state.difficulty,
-        category: this.state.category
+        difficulty: parseInt(this.state.difficulty, 10),
+        category: parseInt(this.state.category, 10)
       }),
       xhrFields: {
         withCredentials: true